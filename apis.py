@@ -1,18 +1,120 @@
 import os
 import time
+import atexit
 import logging
-from datetime import datetime
+import functools
+import random
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
+import orjson
 import requests
 import psycopg
+from psycopg_pool import ConnectionPool
+from requests.adapters import HTTPAdapter
 
 
+__all__ = [
+    "get_access_token",
+    "send_discord_alert",
+    "get_new_released_albums",
+    "get_top_tracks_from_chart",
+    "insert_data_from_top_tracks",
+]
+
+
+logger = logging.getLogger(__name__)
+
 MAX_RETRIES = 5
+MAX_RETRY_AFTER = 60  # seconds
+MAX_BACKOFF = 30  # seconds
+TIMEOUT = (3.05, 10)  # (connect, read) seconds
+DB_TIMEOUT = 3  # seconds
+MAX_WORKERS = 4
+
+NEW_RELEASES_URL = (
+    "https://api.spotify.com/v1/browse/new-releases?limit=50"  # Max limit is 50
+)
+
+# Shared session to reuse keep-alive connections across calls to the same host.
+# Retries are handled by each function, so the adapter itself never retries.
+_session = requests.Session()
+_session.mount(
+    "https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+)
+
+
+@functools.lru_cache(maxsize=1)
+def _db_conninfo() -> str:
+    """Build the main (PostgreSQL) database conninfo from environment variables.
+
+    Read on first use, so jobs that never touch the database don't need them.
+
+    Returns:
+        Connection string for psycopg.
+
+    Raises:
+        psycopg.DatabaseError: If any of the DB_* environment variables is not set.
+    """
+
+    try:
+        return (
+            f"dbname={os.environ['DB_NAME']} user={os.environ['DB_USER']} "
+            f"password={os.environ['DB_PASSWORD']} host={os.environ['DB_HOST']}"
+        )
+    except KeyError as e:
+        # Not a KeyError, which callers would take for a missing field in API data
+        raise psycopg.DatabaseError(f"Environment variable not set: {e}") from e
+
+
+@functools.lru_cache(maxsize=1)
+def _get_pool() -> ConnectionPool:
+    """Create and open the main database connection pool on first use.
+
+    Returns:
+        The process-wide ConnectionPool, closed at exit.
+    """
+
+    pool = ConnectionPool(
+        _db_conninfo(),
+        min_size=1,
+        max_size=4,
+        kwargs={"autocommit": False, "connect_timeout": DB_TIMEOUT},
+        # Not the 30s default, so a down database fails fast. The pool logs the
+        # underlying connection error, which PoolTimeout itself doesn't carry
+        timeout=DB_TIMEOUT,
+        open=True,
+    )
+    atexit.register(pool.close)
+    return pool
+
 
-DB_HOST = os.environ["DB_HOST"]
-DB_NAME = os.environ["DB_NAME"]
-DB_USER = os.environ["DB_USER"]
-DB_PASSWORD = os.environ["DB_PASSWORD"]
+def _sleep_before_retry(
+    retries: int, response: requests.Response | None = None
+) -> None:
+    """Sleep before the next retry attempt.
+
+    Honors the 'Retry-After' header of a 429 or 503 response (capped at
+    MAX_RETRY_AFTER seconds), otherwise backs off exponentially with jitter
+    (capped at MAX_BACKOFF seconds) so concurrent workers don't retry in lockstep.
+
+    Args:
+        retries (int): Number of failed attempts so far.
+        response (requests.Response | None): Response of the failed attempt, if any.
+    """
+
+    if response is not None and response.status_code in (429, 503):
+        try:
+            retry_after = float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            pass  # Missing or HTTP-date 'Retry-After', fall back to backoff
+        else:
+            time.sleep(min(max(retry_after, 0), MAX_RETRY_AFTER))
+            return
+
+    # 2, 4, 8, 16, ... on average, each scaled by a random factor in [0.5, 1.5)
+    time.sleep(min(MAX_BACKOFF, (2**retries) * (0.5 + random.random())))
 
 
 def get_access_token(client_string: str) -> str:
@@ -31,33 +133,41 @@ def get_access_token(client_string: str) -> str:
     retries = 0
 
     while retries < MAX_RETRIES:
+        response = None
         try:
-            response = requests.post(
+            response = _session.post(
                 "https://accounts.spotify.com/api/token",
                 headers={
                     "Authorization": f"Basic {client_string}",
                     "Content-Type": "application/x-www-form-urlencoded",
                 },
                 data={"grant_type": "client_credentials"},
+                timeout=TIMEOUT,
             )
 
-            if response.ok:
-                response_data = response.json()
-                return response_data["access_token"]  # Early return
+            if response.status_code == 200:
+                response_data = orjson.loads(response.content)
+                access_token = response_data["access_token"]
+                return access_token  # Early return
 
-            logging.warning("Response not OK from '/api/token' Spotify endpoint")
+            logger.warning("Response not OK from '/api/token' Spotify endpoint")
         except KeyError:
-            logging.warning(
+            logger.warning(
                 "access_token not found in response from '/api/token' Spotify endpoint"
             )
+        except orjson.JSONDecodeError as e:
+            logger.warning(
+                "JSONDecodeError when parsing response from '/api/token' Spotify endpoint: %s",
+                e,
+            )
         except requests.RequestException as e:
-            logging.warning(
+            logger.warning(
                 "RequestException when calling '/api/token' Spotify endpoint: %s", e
             )
 
         retries += 1
         if retries < MAX_RETRIES:
-            time.sleep(2**retries)  # 2, 4, 8, 16, ...
+            _sleep_before_retry(retries, response)
 
     raise ValueError("Failed to get access_token from Spotify after max retries")
 
@@ -78,101 +188,181 @@ def send_discord_alert(
     retries = 0
 
     while retries < MAX_RETRIES:
+        response = None
         try:
-            response = requests.post(
+            response = _session.post(
                 f"https://discord.com/api/webhooks/{discord_webhook_id}/{discord_webhook_token}",
                 json={"content": message},
+                timeout=TIMEOUT,
             )
 
             if response.ok:
-                logging.info(
-                    "Successfully sent Discord alert with message: %s", message
-                )
+                logger.info("Successfully sent Discord alert with message: %s", message)
                 return  # Early return
 
-            logging.warning("Response not OK when sending Discord webhook alert")
+            logger.warning("Response not OK when sending Discord webhook alert")
         except requests.RequestException as e:
-            logging.warning("RequestException when calling Discord webhook: %s", e)
+            logger.warning("RequestException when calling Discord webhook: %s", e)
 
         retries += 1
         if retries < MAX_RETRIES:
-            time.sleep(2**retries)  # 2, 4, 8, 16, ...
+            _sleep_before_retry(retries, response)
 
-    logging.error("Failed to send Discord alert after max retries")
+    logger.error("Failed to send Discord alert after max retries")
 
 
-def get_new_released_albums(
-    access_token: str,
-) -> dict[str, dict]:
-    """Get new released albums from Spotify API with retries.
+def _check_pagination(albums: dict) -> None:
+    """Check the fields needed to page through new released albums.
+
+    Args:
+        albums (dict): The albums data of a page from Spotify API.
+
+    Raises:
+        KeyError: If 'limit' or 'total' is missing, or not a usable integer.
+    """
+
+    limit, total = albums["limit"], albums["total"]
+    if not (isinstance(limit, int) and limit > 0 and isinstance(total, int)):
+        raise KeyError(f"limit={limit!r}, total={total!r}")
+
+
+def _get_new_released_albums_page(
+    url: str, access_token: str, cached: tuple[str, dict] | None = None
+) -> tuple[str, dict]:
+    """Get a single page of new released albums from Spotify API with retries.
+
+    If the page was fetched before, it is requested conditionally with its ETag,
+    and the cached albums data is reused when Spotify answers 304 Not Modified.
 
     Args:
+        url (str): The page url of '/browse/new-releases' Spotify endpoint.
         access_token (str): Spotify access_token.
+        cached (tuple[str, dict] | None): Previously fetched ETag and albums data.
 
     Returns:
-        A dictionary mapping ETag to the albums data from Spotify API.
-        Possibly partially complete if some page(s) failed after max retries.
-        Typically, the pages are limited to two pages, and items per page is 50.
-        For example: {
-            "etag1": {albums data 1},
-            "etag2": {albums data 2},
-        }
+        A tuple of the page's ETag and its albums data from Spotify API.
 
     Raises:
-        ValueError: If failed to get any new released albums after max retries.
+        ValueError: If failed to get the page after max retries.
     """
 
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if cached is not None:
+        headers["If-None-Match"] = f'"{cached[0]}"'
+
     retries = 0
-    entire_albums = {}
-    url = "https://api.spotify.com/v1/browse/new-releases?limit=50"  # Max limit is 50
 
     while retries < MAX_RETRIES:
+        response = None
         try:
-            response = requests.get(
-                url,
-                headers={"Authorization": f"Bearer {access_token}"},
-            )
+            response = _session.get(url, headers=headers, timeout=TIMEOUT)
 
-            if response.ok:
-                response_data = response.json()
-                albums = response_data["albums"]
-                etag = response.headers["ETag"]  # Case insensitive
-                etag = etag.strip('"')
-                entire_albums[etag] = albums
+            if response.status_code == 304 and cached is not None:
+                return cached  # Early return: page not modified
 
-                next_url = albums.get("next")
-                if next_url is None:
-                    return entire_albums  # Happy path: entire url calls succeeded
+            if response.status_code == 200:
+                etag = response.headers["etag"].strip('"')  # Case insensitive
+                if cached is not None and etag == cached[0]:
+                    return cached  # Early return: unchanged, skip decoding
 
-                url = next_url
-                retries = 0  # Reset retries for the next url page
-                continue
+                response_data = orjson.loads(response.content)
+                albums = response_data["albums"]
+                if albums.get("next") is not None:
+                    _check_pagination(albums)  # Retried here, rather than failing later
+                return etag, albums  # Early return
 
-            logging.warning(
+            logger.warning(
                 "Response not OK from '/browse/new-releases' Spotify endpoint"
             )
         except KeyError as e:
-            logging.warning("KeyError when parsing response from Spotify: %s", e)
+            logger.warning("KeyError when parsing response from Spotify: %s", e)
+        except orjson.JSONDecodeError as e:
+            logger.warning("JSONDecodeError when parsing response from Spotify: %s", e)
         except requests.RequestException as e:
-            logging.warning(
+            logger.warning(
                 "RequestException when calling '/browse/new-releases' Spotify endpoint: %s",
                 e,
             )
 
         retries += 1
         if retries < MAX_RETRIES:
-            time.sleep(2**retries)  # 2, 4, 8, 16, ...
+            _sleep_before_retry(retries, response)
+
+    raise ValueError(f"Failed to get new released albums page from Spotify: {url}")
+
+
+def get_new_released_albums(
+    access_token: str,
+    cache: dict[str, tuple[str, dict]] | None = None,
+) -> Iterator[tuple[str, dict]]:
+    """Get new released albums from Spotify API with retries, page by page.
+
+    The first page is fetched alone to learn the total, then the remaining
+    pages are fetched concurrently. Each page is yielded as soon as it (and
+    the pages before it) arrived, so it can be saved while the rest download.
+
+    Args:
+        access_token (str): Spotify access_token.
+        cache (dict | None): Previously fetched pages, mapping page url to its
+            ETag and albums data. Pages not modified since are not downloaded
+            again, and the cache is updated in place with the fetched pages.
+            Only the 'limit', 'total' and 'next' fields of cached data are read.
+
+    Yields:
+        Tuples of the ETag and the albums data of a page from Spotify API.
+        Possibly partially complete if some page(s) failed after max retries.
+        Typically, the pages are limited to two pages, and items per page is 50.
+        For example: ("etag1", {albums data 1}), ("etag2", {albums data 2})
+        Pages not modified since are yielded with their cached data as is.
+
+    Raises:
+        ValueError: If failed to get any new released albums after max retries.
+    """
 
-    if entire_albums:
-        logging.error(
-            "Partially succeeded to get new released albums from Spotify after max retries. Failed at url: %s",
-            url,
+    if cache is None:
+        cache = {}
+
+    try:
+        etag, albums = _get_new_released_albums_page(
+            NEW_RELEASES_URL, access_token, cache.get(NEW_RELEASES_URL)
         )
-        return entire_albums
+    except ValueError as e:
+        raise ValueError(
+            "Failed to get any new released albums from Spotify after max retries"
+        ) from e
+
+    cache[NEW_RELEASES_URL] = (etag, albums)
+    if albums.get("next") is None:
+        yield etag, albums
+        return  # Happy path: single page
+
+    urls = [
+        f"{NEW_RELEASES_URL}&offset={offset}"
+        for offset in range(albums["limit"], albums["total"], albums["limit"])
+    ]
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                _get_new_released_albums_page, url, access_token, cache.get(url)
+            )
+            for url in urls
+        ]
+        # Only now, so the remaining pages download while the first is consumed
+        yield etag, albums
+
+        for url, future in zip(urls, futures):
+            try:
+                etag, albums = future.result()
+            except ValueError:
+                logger.error(
+                    "Partially succeeded to get new released albums from Spotify after max retries. Failed at url: %s",
+                    url,
+                )
+                continue
 
-    raise ValueError(
-        "Failed to get any new released albums from Spotify after max retries"
-    )
+            cache[url] = (etag, albums)
+            yield etag, albums
 
 
 def get_top_tracks_from_chart(
@@ -204,110 +394,131 @@ def get_top_tracks_from_chart(
         ValueError: If failed to get top tracks from chart after max retries.
     """
 
+    url = f"https://ws.audioscrobbler.com/2.0/?method=chart.gettoptracks&api_key={api_key}&format=json&limit=1000"  # Max limit is 1000
     retries = 0
 
     while retries < MAX_RETRIES:
-        if 0 < retries:
-            time.sleep(2**retries)  # 2, 4, 8, 16, ...
-
+        response = None
         try:
-            response = requests.get(
-                f"https://ws.audioscrobbler.com/2.0/?method=chart.gettoptracks&api_key={api_key}&format=json&limit=1000"  # Max limit is 1000
-            )
+            response = _session.get(url, timeout=TIMEOUT)
 
             if response.status_code == 200:
-                return response.json()  # Early return
+                return orjson.loads(response.content)  # Early return
 
-            logging.warning(
+            logger.warning(
                 "Response not OK when calling 'chart.gettoptracks' endpoint. Status code: %s",
                 response.status_code,
             )
+        except orjson.JSONDecodeError as e:
+            logger.warning(
+                "JSONDecodeError when parsing response from 'chart.gettoptracks' endpoint: %s",
+                e,
+            )
         except requests.RequestException:
-            logging.warning(
+            logger.warning(
                 "RequestException when calling 'chart.gettoptracks' endpoint"
             )
 
         retries += 1
+        if retries < MAX_RETRIES:
+            _sleep_before_retry(retries, response)
 
     raise ValueError("Failed to get top tracks from chart after max retries")
 
 
-def insert_data_from_top_tracks(top_tracks: list[dict[str, str | dict | list]]) -> None:
+def insert_data_from_top_tracks(
+    top_tracks: list[dict[str, str | dict | list]], chart_date: datetime
+) -> None:
     """Insert data from top tracks into main (PostgreSQL) database.
 
     Args:
         top_tracks (list[dict]): List of track data from chart.getTopTracks API.
+        chart_date (datetime): When the chart was fetched, recorded in UTC to the minute.
 
     Raises:
         psycopg.DatabaseError: If failed to insert data after max retries.
     """
 
+    if not top_tracks:
+        return  # Nothing to insert
+
+    # The TIMESTAMP column has no time zone, so it holds UTC wall-clock time
+    utc_chart_date = chart_date.astimezone(timezone.utc).replace(tzinfo=None)
+    # The chart lists many tracks per artist, so send each artist (and track) once
+    artists = {track["artist"]["url"]: track["artist"]["name"] for track in top_tracks}
+    tracks = {track["url"]: track for track in top_tracks}
+    params = {
+        "artist_names": list(artists.values()),
+        "artist_urls": list(artists),
+        "track_names": [track["name"] for track in tracks.values()],
+        "track_artist_urls": [track["artist"]["url"] for track in tracks.values()],
+        "track_urls": list(tracks),
+        "chart_urls": [track["url"] for track in top_tracks],
+        "playcounts": [track["playcount"] for track in top_tracks],
+        "listeners": [track["listeners"] for track in top_tracks],
+        # Shared by every row, so the whole chart is recorded at the same timestamp
+        "chart_date": utc_chart_date.isoformat(timespec="minutes"),
+    }
+    pool = _get_pool()
     retries = 0
 
     while retries < MAX_RETRIES:
         if 0 < retries:
-            time.sleep(2**retries)  # 2, 4, 8, 16, ...
+            _sleep_before_retry(retries)
 
         try:
-            with psycopg.connect(
-                f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST}"
-            ) as conn:
-                with conn.cursor() as cur:
-                    cur.executemany(
+            with pool.connection() as conn:
+                # Separate statements in one transaction (and round trip): under READ
+                # COMMITTED each one takes a fresh snapshot, so it also sees artists and
+                # tracks that a concurrent job committed while the previous one waited
+                with conn.pipeline():
+                    conn.execute(
                         """
                         INSERT INTO artists (name, lastfm_url)
-                        SELECT %s, %s
-                        WHERE NOT EXISTS (
-                            SELECT * FROM artists WHERE lastfm_url = %s
-                        )
+                        SELECT * FROM UNNEST(%(artist_names)s::text[], %(artist_urls)s::text[])
+                        ON CONFLICT (lastfm_url) DO NOTHING
                         """,
-                        [
-                            (
-                                track["artist"]["name"],
-                                track["artist"]["url"],
-                                track["artist"]["url"],  # for 'WHERE NOT EXISTS' clause
-                            )
-                            for track in top_tracks
-                        ],
+                        params,
                     )
-                    cur.executemany(
+                    conn.execute(
                         """
                         INSERT INTO tracks (name, artist_id, lastfm_url)
-                        SELECT %s, (SELECT id FROM artists WHERE lastfm_url = %s), %s
-                        WHERE NOT EXISTS (
-                            SELECT * FROM tracks WHERE lastfm_url = %s
-                        )
+                        SELECT t.name, a.id, t.lastfm_url
+                        FROM UNNEST(
+                            %(track_names)s::text[],
+                            %(track_artist_urls)s::text[],
+                            %(track_urls)s::text[]
+                        ) AS t (name, artist_url, lastfm_url)
+                        JOIN artists AS a ON a.lastfm_url = t.artist_url
+                        ON CONFLICT (lastfm_url) DO NOTHING
                         """,
-                        [
-                            (
-                                track["name"],
-                                track["artist"]["url"],  # to identify artist_id FK
-                                track["url"],
-                                track["url"],  # for 'WHERE NOT EXISTS' clause
-                            )
-                            for track in top_tracks
-                        ],
+                        params,
                     )
-                    cur.executemany(
+                    cur = conn.execute(
                         """
                         INSERT INTO chart_histories (track_id, playcount, listener, chart_date, rank)
-                        VALUES ((SELECT id FROM tracks WHERE lastfm_url = %s), %s, %s, %s, %s)
+                        SELECT t.id, c.playcount, c.listener, %(chart_date)s::timestamp, c.rank
+                        FROM UNNEST(
+                            %(chart_urls)s::text[],
+                            %(playcounts)s::integer[],
+                            %(listeners)s::integer[]
+                        ) WITH ORDINALITY AS c (lastfm_url, playcount, listener, rank)  -- rank from 1
+                        JOIN tracks AS t USING (lastfm_url)
                         """,
-                        [
-                            (
-                                track["url"],  # to identify track_id FK
-                                track["playcount"],
-                                track["listeners"],
-                                datetime.now().isoformat(timespec="minutes"),
-                                index + 1,  # rank starts from 1
-                            )
-                            for index, track in enumerate(top_tracks)
-                        ],
+                        params,
+                    )
+
+                # Every chart row should join a track by now, so fail loudly rather than
+                # silently storing a partial chart
+                if cur.rowcount != len(top_tracks):
+                    raise psycopg.DatabaseError(
+                        f"Inserted {cur.rowcount} of {len(top_tracks)} chart histories"
                     )
         except psycopg.OperationalError as e:
-            logging.warning(
+            logger.warning(
                 "Database operational error when inserting data from top tracks: %s", e
             )
+            pool.check()  # Replace broken connections before the next attempt
         else:
             return
 
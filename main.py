@@ -2,12 +2,18 @@ import os
 import base64
 import argparse
 import logging
-import json
-from datetime import datetime
-
+import logging.handlers
+import queue
+import atexit
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import orjson
 import psycopg
 
 from apis import (
+    MAX_WORKERS,
     get_access_token,
     send_discord_alert,
     get_new_released_albums,
@@ -16,17 +22,76 @@ from apis import (
 )
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(levelname)s] %(asctime)s %(message)s",
-    datefmt="%Y-%m-%dT%H:%M:%S%z",
-    handlers=[logging.FileHandler("main.log")],
-)
+logger = logging.getLogger(__name__)
+
+_NEW_RELEASES_DIR = "./data/get_new_releases/"
+# Outside the pages directory, which only holds albums data files
+_NEW_RELEASES_INDEX = "./data/get_new_releases.json"
+_TOP_TRACKS_DIR = "./data/chart/get_top_tracks/"
+
+
+class _BufferedFileHandler(logging.FileHandler):
+    """FileHandler that lets its stream buffer records instead of flushing each one.
+
+    The stream is flushed when the buffer fills, on ERROR (or higher) records,
+    and on close, collapsing many small writes into a few large ones.
+    """
+
+    def __init__(self, filename: str, buffer_size: int = 64 * 1024) -> None:
+        self.buffer_size = buffer_size
+        super().__init__(filename)
+
+    def _open(self):
+        return open(
+            self.baseFilename,
+            self.mode,
+            buffering=self.buffer_size,
+            encoding=self.encoding,
+            errors=self.errors,
+        )
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.ERROR:
+                self.stream.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+def _setup_logging() -> None:
+    """Log to main.log through a queue, drained by a background listener thread.
+
+    The job only enqueues records, and the listener formats and writes them.
+    """
+
+    log_queue = queue.Queue(-1)
+    file_handler = _BufferedFileHandler("main.log")
+    file_handler.setFormatter(
+        logging.Formatter(
+            fmt="[%(levelname)s] %(asctime)s %(message)s",
+            datefmt="%Y-%m-%dT%H:%M:%S%z",
+        )
+    )
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    # atexit runs in reverse order: drain the queue first, then flush the file
+    atexit.register(file_handler.flush)
+    atexit.register(listener.stop)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",  # Only merges args, the file handler applies the format
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+    )
 
 
 def refresh_access_token(
-    client_id: str,
-    client_secret: str,
+    client_string: str,
     discord_webhook_id: str,
     discord_webhook_token: str,
 ) -> None:
@@ -35,27 +100,26 @@ def refresh_access_token(
     If failed to refresh access_token, it will send alert to Discord webhook.
 
     Args:
-        client_id (str): Spotify Client ID.
-        client_secret (str): Spotify Client Secret.
+        client_string (str): Base64 encoded "client_id:client_secret".
         discord_webhook_id (str): The ID of the Discord webhook.
         discord_webhook_token (str): The token of the Discord webhook.
     """
 
     try:
-        access_token = get_access_token(
-            client_string=base64.b64encode(
-                f"{client_id}:{client_secret}".encode()
-            ).decode()
-        )
+        access_token = get_access_token(client_string=client_string)
 
-        with open("access_token.txt", "w") as f:
+        # Write aside and rename, so readers never see a partially written token
+        with open("access_token.txt.tmp", "w") as f:
             f.write(access_token)
-            logging.info(
-                "access_token refreshed to '%s' and saved to access_token.txt",
-                access_token,
-            )
+            f.flush()
+            os.fsync(f.fileno())  # Make the data durable before the rename is
+        os.replace("access_token.txt.tmp", "access_token.txt")
+        logger.info(
+            "access_token refreshed and saved to access_token.txt (len=%d)",
+            len(access_token),
+        )
     except ValueError:
-        logging.error("Failed to get access_token from Spotify after max retries")
+        logger.error("Failed to get access_token from Spotify after max retries")
         send_discord_alert(
             message="Failed to refresh access_token from Spotify. This job will retry in the next scheduled run (approx. 20 mins).",
             discord_webhook_id=discord_webhook_id,
@@ -63,8 +127,78 @@ def refresh_access_token(
         )
 
 
+def _save_json(path: str, data) -> None:
+    """Save data to path as indented json.
+
+    Args:
+        path (str): The file path to write.
+        data: The json serializable data.
+
+    Raises:
+        JSONEncodeError: If data can't be serialized to json.
+    """
+
+    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    with open(path, "wb") as f:
+        f.write(payload)
+
+
+def _is_index_entry(page) -> bool:
+    """Check a new released albums index entry, as written by get_new_releases.
+
+    Args:
+        page: The entry of a page url in the index.
+
+    Returns:
+        Whether the entry has a string 'etag', and a usable 'limit' and 'total'
+        if there is a 'next' page to fetch from them.
+    """
+
+    if not isinstance(page, dict) or not isinstance(page.get("etag"), str):
+        return False
+    if page.get("next") is None:
+        return True
+
+    limit, total = page.get("limit"), page.get("total")
+    return isinstance(limit, int) and limit > 0 and isinstance(total, int)
+
+
+def load_new_releases_cache() -> dict[str, tuple[str, dict]]:
+    """Load the index of previously saved new released albums pages.
+
+    Only the index is read, not the page files: an unchanged page is neither
+    decoded from the response nor saved again, so its albums data isn't needed.
+
+    Returns:
+        A dictionary mapping page url to its ETag and pagination fields
+        ('limit', 'total' and 'next'), for conditional requests. Pages whose
+        saved file is missing are left out, so they are downloaded again.
+    """
+
+    try:
+        with open(_NEW_RELEASES_INDEX, "rb") as f:
+            index = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    if not isinstance(index, dict):
+        return {}  # Not an index this job wrote, so every page is downloaded again
+
+    cache = {}
+    for url, page in index.items():
+        if not _is_index_entry(page):
+            continue  # Hand edited or of an older shape, the page is downloaded again
+        etag = page.pop("etag")
+        if os.path.exists(_NEW_RELEASES_DIR + etag + ".json"):
+            cache[url] = (etag, page)
+
+    return cache
+
+
 def get_new_releases(
-    access_token: str, discord_webhook_id: str, discord_webhook_token: str
+    access_token: str,
+    discord_webhook_id: str,
+    discord_webhook_token: str,
+    verbose: bool = False,
 ) -> None:
     """Get new released albums from Spotify and save to ./data/get_new_releases.
 
@@ -72,29 +206,64 @@ def get_new_releases(
         access_token (str): Spotify access_token.
         discord_webhook_id (str): The ID of the Discord webhook.
         discord_webhook_token (str): The token of the Discord webhook.
+        verbose (bool): Whether to also alert Discord on success.
 
     Raises:
         ValueError: If failed to get any new released albums after max retries.
-        JSONDecodeError: If failed to save new released albums data to json.
+        JSONEncodeError: If failed to save new released albums data to json.
     """
 
     try:
         # TODO: handle alerts for partial success
-        albums = get_new_released_albums(access_token=access_token)
-
-        for etag, data in albums.items():
-            os.makedirs("./data/get_new_releases", exist_ok=True)
-            with open(f"./data/get_new_releases/{etag}.json", "w") as f:
-                json.dump(data, f, indent=2)
-                logging.info("Saved new released albums data to %s.json", etag)
+        cache = load_new_releases_cache()
+        # Files of these pages are already saved, so they don't need rewriting
+        saved_etags = {etag for etag, _ in cache.values()}
+        fetched_etags = []
+
+        os.makedirs(_NEW_RELEASES_DIR, exist_ok=True)
+        # Pages are saved in the background as they arrive, while the remaining
+        # ones are still downloading and other pages are being written. Workers
+        # are only started as pages are submitted, so idle ones cost nothing
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            saves = {}
+            for etag, data in get_new_released_albums(
+                access_token=access_token, cache=cache
+            ):
+                fetched_etags.append(etag)
+                path = _NEW_RELEASES_DIR + etag + ".json"
+                if etag in saved_etags:
+                    logger.info("Albums data of %s unchanged, skipped saving", path)
+                    continue
+                saves[path] = executor.submit(_save_json, path, data)
+
+            for path, saved in saves.items():
+                saved.result()
+                logger.info("Saved new released albums data to %s", path)
+
+        _save_json(
+            _NEW_RELEASES_INDEX,
+            {
+                url: {
+                    "etag": etag,
+                    "limit": albums.get("limit"),
+                    "total": albums.get("total"),
+                    "next": albums.get("next"),
+                }
+                for url, (etag, albums) in cache.items()
+                if etag in fetched_etags
+            },
+        )
 
+        if verbose:
+            # One alert for all pages, rather than a webhook call per page
+            saved_files = "\n".join(f"{etag}.json" for etag in fetched_etags)
             send_discord_alert(
-                message=f"Successfully got new released albums from Spotify and saved to ./data/get_new_releases/{etag}.json.",
+                message=f"Successfully got new released albums from Spotify and saved to ./data/get_new_releases:\n{saved_files}",
                 discord_webhook_id=discord_webhook_id,
                 discord_webhook_token=discord_webhook_token,
             )
     except ValueError:
-        logging.error(
+        logger.error(
             "Failed to get any new released albums from Spotify after max retries"
         )
         send_discord_alert(
@@ -102,8 +271,8 @@ def get_new_releases(
             discord_webhook_id=discord_webhook_id,
             discord_webhook_token=discord_webhook_token,
         )
-    except json.JSONDecodeError as e:
-        logging.error("Failed to save new released albums data to json: %s", e)
+    except orjson.JSONEncodeError as e:
+        logger.error("Failed to save new released albums data to json: %s", e)
         send_discord_alert(
             message="Failed to save new released albums data to json.",
             discord_webhook_id=discord_webhook_id,
@@ -111,8 +280,39 @@ def get_new_releases(
         )
 
 
+def _report_top_tracks_saved(
+    saved: Future, path: str, discord_webhook_id: str, discord_webhook_token: str
+) -> None:
+    """Log the result of saving top tracks, and alert Discord if it failed.
+
+    Reported apart from the database insert run alongside, so that a failure of
+    one doesn't hide the other.
+
+    Args:
+        saved (Future): The future of saving top tracks data to json.
+        path (str): The file path the top tracks were saved to.
+        discord_webhook_id (str): The ID of the Discord webhook.
+        discord_webhook_token (str): The token of the Discord webhook.
+    """
+
+    try:
+        saved.result()
+    except orjson.JSONEncodeError as e:
+        logger.error("Failed to save top tracks data to json: %s", e)
+        send_discord_alert(
+            message="Failed to save top tracks data to json.",
+            discord_webhook_id=discord_webhook_id,
+            discord_webhook_token=discord_webhook_token,
+        )
+    else:
+        logger.info("Saved top tracks from Last.fm chart to %s", path)
+
+
 def chart_get_top_tracks(
-    api_key: str, discord_webhook_id: str, discord_webhook_token: str
+    api_key: str,
+    discord_webhook_id: str,
+    discord_webhook_token: str,
+    verbose: bool = False,
 ) -> None:
     """Get top tracks from Last.fm chart and insert into database.
 
@@ -120,50 +320,54 @@ def chart_get_top_tracks(
         api_key (str): Last.fm API key.
         discord_webhook_id (str): The ID of the Discord webhook.
         discord_webhook_token (str): The token of the Discord webhook.
+        verbose (bool): Whether to also alert Discord on success.
     """
 
     try:
         tracks = get_top_tracks_from_chart(api_key=api_key)
-        now = datetime.now().isoformat(timespec="minutes")
-
-        os.makedirs("./data/chart/get_top_tracks", exist_ok=True)
-        with open(f"./data/chart/get_top_tracks/{now}.json", "w") as f:
-            json.dump(tracks, f, indent=2)
-            logging.info("Saved top tracks from Last.fm chart to %s.json", now)
-
-        insert_data_from_top_tracks(top_tracks=tracks["tracks"]["track"])
-
-        logging.info(
+        # One UTC timestamp for the snapshot and its rows, so both sort in order
+        # across DST changes; no colons in the file name for portability
+        now = datetime.now(timezone.utc)
+        path = _TOP_TRACKS_DIR + now.strftime("%Y-%m-%dT%H-%MZ") + ".json"
+
+        os.makedirs(_TOP_TRACKS_DIR, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Write the snapshot in the background while the database insert runs
+            saved = executor.submit(_save_json, path, tracks)
+            try:
+                insert_data_from_top_tracks(
+                    top_tracks=tracks["tracks"]["track"], chart_date=now
+                )
+            finally:
+                _report_top_tracks_saved(
+                    saved, path, discord_webhook_id, discord_webhook_token
+                )
+
+        logger.info(
             "Successfully got top tracks from Last.fm chart and inserted into database."
         )
-        send_discord_alert(
-            message="Successfully got top tracks from Last.fm chart and inserted into database.",
-            discord_webhook_id=discord_webhook_id,
-            discord_webhook_token=discord_webhook_token,
-        )
+        if verbose:
+            send_discord_alert(
+                message="Successfully got top tracks from Last.fm chart and inserted into database.",
+                discord_webhook_id=discord_webhook_id,
+                discord_webhook_token=discord_webhook_token,
+            )
     except ValueError as e:
-        logging.error(e)
+        logger.error(e)
         send_discord_alert(
             message="Failed to get top tracks from Last.fm chart.",
             discord_webhook_id=discord_webhook_id,
             discord_webhook_token=discord_webhook_token,
         )
-    except json.JSONDecodeError as e:
-        logging.error("Failed to save top tracks data to json: %s", e)
-        send_discord_alert(
-            message="Failed to save top tracks data to json.",
-            discord_webhook_id=discord_webhook_id,
-            discord_webhook_token=discord_webhook_token,
-        )
     except KeyError as e:
-        logging.error("KeyError from chart.getTopTracks data: %s", e)
+        logger.error("KeyError from chart.getTopTracks data: %s", e)
         send_discord_alert(
             message="KeyError from chart.getTopTracks data.",
             discord_webhook_id=discord_webhook_id,
             discord_webhook_token=discord_webhook_token,
         )
     except psycopg.DatabaseError as e:
-        logging.error("Database error when inserting data from top tracks: %s", e)
+        logger.error("Database error when inserting data from top tracks: %s", e)
         send_discord_alert(
             message="Database error when inserting data from top tracks.",
             discord_webhook_id=discord_webhook_id,
@@ -171,57 +375,108 @@ def chart_get_top_tracks(
         )
 
 
+def _client_string(environ: Mapping[str, str]) -> str:
+    """Build the Spotify client string from environment variables.
+
+    Args:
+        environ (Mapping[str, str]): The environment variables.
+
+    Returns:
+        Base64 encoded "client_id:client_secret".
+
+    Raises:
+        KeyError: If SPTFY_CLIENT_ID or SPTFY_CLIENT_SECRET is not set.
+    """
+
+    client_id = environ["SPTFY_CLIENT_ID"]
+    client_secret = environ["SPTFY_CLIENT_SECRET"]
+    return base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+
+
+def _verbose(environ: Mapping[str, str]) -> bool:
+    """Read whether success alerts are sent, from the DSCRD_VERBOSE environment variable.
+
+    Args:
+        environ (Mapping[str, str]): The environment variables.
+
+    Returns:
+        True if DSCRD_VERBOSE=1. Failure alerts are always sent regardless.
+    """
+
+    return environ.get("DSCRD_VERBOSE") == "1"
+
+
+# Job name -> (function, {parameter: environment variable, or a function building
+# the argument from the environment}, whether it needs access_token.txt)
+JOBS = {
+    "refresh_access_token": (
+        refresh_access_token,
+        {
+            "client_string": _client_string,
+            "discord_webhook_id": "DSCRD_WEBHOOK_ID",
+            "discord_webhook_token": "DSCRD_WEBHOOK_TOKEN",
+        },
+        False,
+    ),
+    "get_new_releases": (
+        get_new_releases,
+        {
+            "discord_webhook_id": "DSCRD_WEBHOOK_ID",
+            "discord_webhook_token": "DSCRD_WEBHOOK_TOKEN",
+            "verbose": _verbose,
+        },
+        True,
+    ),
+    "chart_get_top_tracks": (
+        chart_get_top_tracks,
+        {
+            "api_key": "LSTFM_API_KEY",
+            "discord_webhook_id": "DSCRD_WEBHOOK_ID",
+            "discord_webhook_token": "DSCRD_WEBHOOK_TOKEN",
+            "verbose": _verbose,
+        },
+        False,
+    ),
+}
+
+
 def main():
     """Main function to parse arguments and execute corresponding job."""
 
+    _setup_logging()
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-j",
         "--job",
         type=str,
         required=True,
-        help="specify the job to run",
+        choices=list(JOBS),
+        help="specify the job to run: %(choices)s",
         metavar="",
     )
     args = parser.parse_args()
+    job, env_vars, needs_access_token = JOBS[args.job]
 
+    # Only read what the job needs, so e.g. a cold start can refresh the token first
     try:
-        client_id = os.environ["SPTFY_CLIENT_ID"]
-        client_secret = os.environ["SPTFY_CLIENT_SECRET"]
-        lastfm_api_key = os.environ["LSTFM_API_KEY"]
-        discord_webhook_id = os.environ["DSCRD_WEBHOOK_ID"]
-        discord_webhook_token = os.environ["DSCRD_WEBHOOK_TOKEN"]
+        kwargs = {
+            param: source(os.environ) if callable(source) else os.environ[source]
+            for param, source in env_vars.items()
+        }
     except KeyError as e:
-        logging.error("Environment variable not set")
+        logger.error("Environment variable not set")
         raise e
 
-    if args.job == "refresh_access_token":
-        refresh_access_token(
-            client_id=client_id,
-            client_secret=client_secret,
-            discord_webhook_id=discord_webhook_id,
-            discord_webhook_token=discord_webhook_token,
-        )
-
-    try:
-        with open("access_token.txt", "r") as f:
-            access_token = f.read()
-    except FileNotFoundError as e:
-        logging.error("access_token.txt file not found")
-        raise e
+    if needs_access_token:
+        try:
+            with open("access_token.txt", "r") as f:
+                kwargs["access_token"] = f.read()
+        except FileNotFoundError as e:
+            logger.error("access_token.txt file not found")
+            raise e
 
-    if args.job == "get_new_releases":
-        get_new_releases(
-            access_token=access_token,
-            discord_webhook_id=discord_webhook_id,
-            discord_webhook_token=discord_webhook_token,
-        )
-    if args.job == "chart_get_top_tracks":
-        chart_get_top_tracks(
-            api_key=lastfm_api_key,
-            discord_webhook_id=discord_webhook_id,
-            discord_webhook_token=discord_webhook_token,
-        )
+    job(**kwargs)
 
 
 if __name__ == "__main__":
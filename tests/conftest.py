@@ -0,0 +1,35 @@
+import os
+from pathlib import Path
+
+import psycopg
+import pytest
+
+import apis
+
+
+INIT_SQL = Path(__file__).resolve().parent.parent / "init.sql"
+
+
+@pytest.fixture
+def db_conninfo(monkeypatch):
+    """Point apis at a throwaway database with freshly created tables.
+
+    Set TEST_DB_CONNINFO to the conninfo of a database that may be wiped,
+    otherwise the database tests are skipped.
+    """
+
+    conninfo = os.environ.get("TEST_DB_CONNINFO")
+    if not conninfo:
+        pytest.skip("TEST_DB_CONNINFO not set")
+
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        conn.execute("DROP TABLE IF EXISTS chart_histories, tracks, artists")
+        conn.execute(INIT_SQL.read_text())
+
+    monkeypatch.setattr(apis, "_db_conninfo", lambda: conninfo)
+    apis._get_pool.cache_clear()
+    yield conninfo
+
+    if apis._get_pool.cache_info().currsize:
+        apis._get_pool().close()
+    apis._get_pool.cache_clear()
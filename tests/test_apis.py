@@ -0,0 +1,195 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import orjson
+import psycopg
+import pytest
+import requests
+
+import apis
+
+
+class FakeSession:
+    """Stands in for apis._session, answering GETs from a list of responses."""
+
+    def __init__(self, *responses: requests.Response) -> None:
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url: str, headers: dict | None = None, **kwargs) -> requests.Response:
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+
+def make_response(
+    status_code: int, data: dict | bytes = b"", headers: dict | None = None
+) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    response._content = data if isinstance(data, bytes) else orjson.dumps(data)
+    return response
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Record retry sleeps instead of sleeping."""
+
+    sleeps = []
+    monkeypatch.setattr(apis.time, "sleep", sleeps.append)
+    return sleeps
+
+
+CHART_DATE = datetime(2026, 1, 2, 3, 4, 56, tzinfo=timezone.utc)
+
+
+def make_track(url: str, artist_url: str, playcount: int = 1) -> dict:
+    return {
+        "name": url.rsplit("/", 1)[-1],
+        "url": url,
+        "playcount": str(playcount),
+        "listeners": str(playcount),
+        "artist": {"name": artist_url.rsplit("/", 1)[-1], "url": artist_url},
+    }
+
+
+def fetch_chart(conninfo: str) -> list[tuple]:
+    with psycopg.connect(conninfo) as conn:
+        return conn.execute(
+            """
+            SELECT t.lastfm_url, a.lastfm_url, c.playcount, c.rank, c.chart_date
+            FROM chart_histories AS c
+            JOIN tracks AS t ON t.id = c.track_id
+            JOIN artists AS a ON a.id = t.artist_id
+            ORDER BY c.rank
+            """
+        ).fetchall()
+
+
+def test_insert_data_from_top_tracks(db_conninfo):
+    top_tracks = [
+        make_track("u/t1", "u/a1", 30),
+        make_track("u/t2", "u/a1", 20),
+        make_track("u/t3", "u/a2", 10),
+    ]
+
+    apis.insert_data_from_top_tracks(top_tracks, CHART_DATE)
+
+    assert fetch_chart(db_conninfo) == [
+        ("u/t1", "u/a1", 30, 1, datetime(2026, 1, 2, 3, 4)),
+        ("u/t2", "u/a1", 20, 2, datetime(2026, 1, 2, 3, 4)),
+        ("u/t3", "u/a2", 10, 3, datetime(2026, 1, 2, 3, 4)),
+    ]
+
+
+def test_insert_data_from_top_tracks_reuses_existing_rows(db_conninfo):
+    apis.insert_data_from_top_tracks([make_track("u/t1", "u/a1")], CHART_DATE)
+    apis.insert_data_from_top_tracks(
+        [make_track("u/t2", "u/a1"), make_track("u/t1", "u/a1")],
+        datetime(2026, 1, 3, tzinfo=timezone.utc),
+    )
+
+    with psycopg.connect(db_conninfo) as conn:
+        assert conn.execute("SELECT count(*) FROM artists").fetchone() == (1,)
+        assert conn.execute("SELECT count(*) FROM tracks").fetchone() == (2,)
+    assert [row[:4] for row in fetch_chart(db_conninfo)] == [
+        ("u/t1", "u/a1", 1, 1),
+        ("u/t2", "u/a1", 1, 1),
+        ("u/t1", "u/a1", 1, 2),
+    ]
+
+
+def test_insert_data_from_top_tracks_sees_rows_of_concurrent_job(db_conninfo):
+    # Another job inserted the same artist and commits while this insert waits on it
+    other = psycopg.connect(db_conninfo)
+    other.execute("INSERT INTO artists (name, lastfm_url) VALUES ('X', 'u/X')")
+    top_tracks = [make_track("u/x1", "u/X"), make_track("u/y1", "u/Y")]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        inserted = executor.submit(
+            apis.insert_data_from_top_tracks, top_tracks, CHART_DATE
+        )
+        with psycopg.connect(db_conninfo, autocommit=True) as conn:
+            deadline = time.monotonic() + 10
+            while not conn.execute(
+                "SELECT 1 FROM pg_stat_activity WHERE wait_event_type = 'Lock'"
+            ).fetchone():
+                assert time.monotonic() < deadline, "insert never waited on the lock"
+                time.sleep(0.05)
+        other.commit()
+        other.close()
+        inserted.result(timeout=10)
+
+    assert [row[:2] for row in fetch_chart(db_conninfo)] == [
+        ("u/x1", "u/X"),
+        ("u/y1", "u/Y"),
+    ]
+
+
+def test_get_new_released_albums_retries_page_without_pagination(monkeypatch, no_sleep):
+    page = {"items": [], "next": "url of page 2"}  # No 'limit' and 'total'
+    session = FakeSession(
+        *(make_response(200, {"albums": page}, {"ETag": '"e"'}),) * apis.MAX_RETRIES
+    )
+    monkeypatch.setattr(apis, "_session", session)
+
+    with pytest.raises(ValueError):
+        list(apis.get_new_released_albums("token"))
+    assert len(session.requests) == apis.MAX_RETRIES
+
+
+@pytest.mark.parametrize(
+    ("retry_after", "expected"),
+    [("5", 5), ("120", apis.MAX_RETRY_AFTER), ("-3", 0)],
+)
+def test_sleep_before_retry_honors_clamped_retry_after(no_sleep, retry_after, expected):
+    apis._sleep_before_retry(
+        1, make_response(429, headers={"Retry-After": retry_after})
+    )
+
+    assert no_sleep == [expected]
+
+
+@pytest.mark.parametrize(
+    "response",
+    [
+        None,
+        make_response(429),
+        make_response(503, headers={"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}),
+        make_response(500, headers={"Retry-After": "5"}),
+    ],
+)
+def test_sleep_before_retry_backs_off_otherwise(no_sleep, response):
+    apis._sleep_before_retry(10, response)  # 2**10 seconds before the cap
+
+    assert no_sleep == [pytest.approx(apis.MAX_BACKOFF)]
+
+
+def test_get_new_released_albums_page_reuses_cache_when_not_modified(monkeypatch):
+    cached = ("e", {"items": [], "next": None})
+    session = FakeSession(make_response(304))
+    monkeypatch.setattr(apis, "_session", session)
+
+    assert apis._get_new_released_albums_page("url", "token", cached) is cached
+    assert session.requests[0][1]["If-None-Match"] == '"e"'
+
+
+def test_get_new_released_albums_page_reuses_cache_for_same_etag(monkeypatch):
+    cached = ("e", {"items": [], "next": None})
+    # Not decoded, otherwise the invalid body would be retried
+    session = FakeSession(make_response(200, b"not json", {"ETag": '"e"'}))
+    monkeypatch.setattr(apis, "_session", session)
+
+    assert apis._get_new_released_albums_page("url", "token", cached) is cached
+
+
+def test_get_new_released_albums_page_decodes_changed_etag(monkeypatch):
+    albums = {"items": [{"id": "a1"}], "next": None}
+    session = FakeSession(make_response(200, {"albums": albums}, {"ETag": '"e2"'}))
+    monkeypatch.setattr(apis, "_session", session)
+
+    assert apis._get_new_released_albums_page("url", "token", ("e1", {})) == (
+        "e2",
+        albums,
+    )
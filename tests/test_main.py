@@ -0,0 +1,84 @@
+import orjson
+import pytest
+
+import main
+
+
+PAGE_1 = "https://api.spotify.com/v1/browse/new-releases?limit=50"
+PAGE_2 = "https://api.spotify.com/v1/browse/new-releases?limit=50&offset=50"
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Run in an empty directory, with the new releases pages directory created."""
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / main._NEW_RELEASES_DIR).mkdir(parents=True)
+    return tmp_path
+
+
+def write_index(data_dir, index) -> None:
+    (data_dir / main._NEW_RELEASES_INDEX).write_bytes(orjson.dumps(index))
+
+
+def save_page(data_dir, etag: str) -> None:
+    (data_dir / main._NEW_RELEASES_DIR / f"{etag}.json").write_bytes(b"{}")
+
+
+def test_load_new_releases_cache_without_index(data_dir):
+    assert main.load_new_releases_cache() == {}
+
+
+def test_load_new_releases_cache_skips_missing_page_file(data_dir):
+    write_index(
+        data_dir,
+        {
+            PAGE_1: {"etag": "e1", "limit": 50, "total": 60, "next": PAGE_2},
+            PAGE_2: {"etag": "e2", "limit": 50, "total": 60, "next": None},
+        },
+    )
+    save_page(data_dir, "e1")
+
+    assert main.load_new_releases_cache() == {
+        PAGE_1: ("e1", {"limit": 50, "total": 60, "next": PAGE_2}),
+    }
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [
+        "e1",  # Older shape: url to ETag
+        {"limit": 50, "total": 60, "next": None},
+        {"etag": 1, "limit": 50, "total": 60, "next": None},
+        {"etag": "e1", "next": PAGE_2},
+        {"etag": "e1", "limit": 0, "total": 60, "next": PAGE_2},
+    ],
+)
+def test_load_new_releases_cache_skips_invalid_entry(data_dir, entry):
+    write_index(
+        data_dir,
+        {
+            PAGE_1: entry,
+            PAGE_2: {"etag": "e2", "limit": 50, "total": 60, "next": None},
+        },
+    )
+    save_page(data_dir, "e1")
+    save_page(data_dir, "e2")
+
+    assert main.load_new_releases_cache() == {
+        PAGE_2: ("e2", {"limit": 50, "total": 60, "next": None}),
+    }
+
+
+def test_load_new_releases_cache_ignores_index_of_other_shape(data_dir):
+    write_index(data_dir, [PAGE_1])
+
+    assert main.load_new_releases_cache() == {}
+
+
+@pytest.mark.parametrize(
+    ("environ", "expected"),
+    [({"DSCRD_VERBOSE": "1"}, True), ({"DSCRD_VERBOSE": ""}, False), ({}, False)],
+)
+def test_verbose_is_read_from_given_environment(environ, expected):
+    assert main._verbose(environ) is expected